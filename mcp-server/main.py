@@ -1,66 +1,314 @@
 import asyncio
+import atexit
 import os
+import re
+import time
+import asyncpg
+import orjson
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from fastmcp import FastMCP, Client
-from supabase import create_client, Client as SupabaseClient
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Optional
 
+# Use uvloop for a faster asyncio event loop where it is available (not on Windows)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # Load environment variables from a .env file
-# Create a .env file in the same directory with your Supabase URL and Key
-# SUPABASE_URL=your_supabase_url
-# SUPABASE_KEY=your_supabase_service_role_key
+# Create a .env file in the same directory with your Supabase pooler connection string
+# SUPABASE_DB_URL=postgresql://postgres.<project-ref>:<password>@<region>.pooler.supabase.com:6543/postgres
 load_dotenv()
 
 # --- Supabase Configuration ---
 # It's highly recommended to use environment variables for security
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")
 
-# Check if the environment variables are set
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase URL and Key must be set in your environment variables or a .env file.")
+# Maximum number of pooled Postgres connections. FastMCP can run many tool calls
+# at once; around 25 connections serves ~100 concurrent callers well, while a much
+# larger pool mostly adds contention on the database side. Tune as needed.
+SUPABASE_POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "25"))
 
-# Initialize Supabase client
-try:
-    supabase: SupabaseClient = create_client(SUPABASE_URL, SUPABASE_KEY)
-    print("Successfully connected to Supabase.")
-except Exception as e:
-    print(f"Error connecting to Supabase: {e}")
-    # Exit if we can't connect to the database
-    exit()
+# Check if the environment variable is set
+if not SUPABASE_DB_URL:
+    raise ValueError("Supabase DB URL must be set in your environment variables or a .env file.")
+
+# --- Postgres Connection Pool ---
+# The tools talk to Postgres directly through Supabase's Supavisor pooler instead of
+# going through PostgREST, which saves the JSON-over-HTTP overhead on every call.
+# The pool is opened by the first client session and then kept for the life of the
+# process: FastMCP enters the lifespan once per client session (once per request
+# over stateless HTTP), so tying the pool to sessions would reconnect constantly.
+pool: Optional[asyncpg.Pool] = None
+
+# Connections, tasks and locks all belong to the event loop they were created on,
+# so the lock is made together with the pool, on the loop that opens it.
+_pool_lock: Optional[asyncio.Lock] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+
+async def _init_connection(con: asyncpg.Connection):
+    """Decode NUMERIC columns as floats so prices serialize as plain JSON numbers."""
+    await con.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+
+async def _startup():
+    """Opens the resources shared by every client session."""
+    global pool
+    try:
+        # Supavisor's transaction mode does not support prepared statements,
+        # so the statement cache has to be disabled.
+        pool = await asyncpg.create_pool(
+            dsn=SUPABASE_DB_URL,
+            min_size=min(2, SUPABASE_POOL_SIZE),
+            max_size=SUPABASE_POOL_SIZE,
+            max_inactive_connection_lifetime=30,
+            statement_cache_size=0,
+            init=_init_connection,
+        )
+        print("Successfully connected to Supabase.")
+    except Exception as e:
+        print(f"Error connecting to Supabase: {e}")
+        raise
+    _start_write_flusher()
+
+def _release_pool():
+    """Drops the shared resources without awaiting, for when their event loop is gone."""
+    global pool, _write_queue, _write_flusher_task
+    closing_pool, pool = pool, None
+    _write_queue = _write_flusher_task = None
+    if closing_pool is not None:
+        try:
+            closing_pool.terminate()
+        except Exception:
+            # The loop is already closed; the sockets go with the process
+            pass
+
+# There is no async hook at process exit, so the pool's connections are terminated
+# rather than closed gracefully; Postgres sees the same as a dropped client.
+atexit.register(_release_pool)
+
+async def _ensure_started():
+    """Opens the shared resources on first use, at most once per event loop."""
+    global _pool_lock, _pool_loop
+    loop = asyncio.get_running_loop()
+    if _pool_loop is not loop:
+        # First use, or a new loop (e.g. a second asyncio.run()) that can't use the old pool
+        _release_pool()
+        _pool_lock, _pool_loop = asyncio.Lock(), loop
+    async with _pool_lock:
+        if pool is None:
+            await _startup()
+        elif _write_flusher_task.done():
+            # The flusher crashed; its error was reported, so start a fresh one
+            _start_write_flusher()
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    """Makes sure the shared Postgres pool is open before a client session starts."""
+    await _ensure_started()
+    yield {}
+
+# --- Symbol Validation ---
+# Ticker symbols are short: letters and digits, plus the '-' and '.' that some
+# CoinGecko tickers use (e.g. BSC-USD). Anything else is rejected before it
+# costs a round-trip to the database.
+_SYMBOL_RE = re.compile(r'[A-Za-z0-9.\-]{1,20}')
+
+# --- Symbol Lookup Cache ---
+# Prices are refreshed by the price agent roughly every 5 seconds, so a lookup
+# result can be reused for that long without going back to the database.
+_sym_cache: TTLCache = TTLCache(maxsize=1024, ttl=5)
+
+# Snapshot of the full table, served to repeated get_all_cryptocurrencies calls
+# for a short window instead of streaming every row again.
+_ALL_CACHE_TTL_SECONDS = 2.0
+_all_cache: Dict[str, Any] = {'ts': 0.0, 'data': None}
+
+# Bumped on every invalidation, so a read that was in flight during a write
+# can tell its result may predate that write and skip caching it.
+_cache_generation = 0
+
+def _invalidate_caches(sym: str):
+    """Drops cached reads that a write to the given (upper-cased) symbol may have made stale."""
+    global _cache_generation
+    _cache_generation += 1
+    _sym_cache.pop(sym, None)
+    _all_cache['data'] = None
+
+# --- Write Batching ---
+# Concurrent add/update tool calls are queued and written together: a background
+# flusher collects everything queued within a short window and issues one
+# set-based statement per operation, then hands each caller its own row.
+_WRITE_BATCH_WINDOW_SECONDS = 0.01
+_WRITE_BATCH_MAX_SIZE = 200
+# Created together with the flusher at server startup, so both use the running loop
+_write_queue: Optional["asyncio.Queue[tuple]"] = None
+_write_flusher_task: Optional[asyncio.Task] = None
+
+def _fail_writes(items: List[tuple], exc: Exception):
+    """Resolves any still-pending writes with the given error."""
+    for _, _, fut in items:
+        if not fut.done():
+            fut.set_exception(exc)
+
+def _fail_queued_writes(queue: "asyncio.Queue[tuple]", exc: Exception):
+    """Drains the queue, failing every write that was never flushed."""
+    while not queue.empty():
+        _fail_writes([queue.get_nowait()], exc)
+
+def _on_write_flusher_done(queue: "asyncio.Queue[tuple]", task: asyncio.Task):
+    """Fails queued writes when the flusher stops, so no caller waits forever."""
+    if task.cancelled():
+        # Only the event loop shutting down cancels the flusher
+        _fail_queued_writes(queue, RuntimeError("The MCP server is shutting down."))
+        return
+    if task.exception() is not None:
+        print(f"Write flusher stopped unexpectedly: {task.exception()!r}")
+    _fail_queued_writes(queue, RuntimeError("The database write flusher is not running."))
+
+def _start_write_flusher():
+    """Creates the write queue and its flusher task on the running event loop."""
+    global _write_queue, _write_flusher_task
+    queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+    task = asyncio.create_task(_write_flusher(queue))
+    task.add_done_callback(lambda t: _on_write_flusher_done(queue, t))
+    _write_queue, _write_flusher_task = queue, task
+
+async def _enqueue_write(op: str, params: tuple) -> Optional[Dict[str, Any]]:
+    """Queues a write for the flusher and waits for its resulting row."""
+    if _write_flusher_task is None or _write_flusher_task.done():
+        raise RuntimeError("The database write flusher is not running.")
+    fut = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((op, params, fut))
+    return await fut
+
+async def _write_flusher(queue: "asyncio.Queue[tuple]"):
+    """Drains the write queue in batches for the lifetime of the server."""
+    while True:
+        batch = [await queue.get()]
+        try:
+            await asyncio.sleep(_WRITE_BATCH_WINDOW_SECONDS)
+            while len(batch) < _WRITE_BATCH_MAX_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            adds = [item for item in batch if item[0] == 'add']
+            updates = [item for item in batch if item[0] == 'update']
+            for flush, items in ((_flush_adds, adds), (_flush_updates, updates)):
+                if not items:
+                    continue
+                try:
+                    await flush(items)
+                except Exception as e:
+                    _fail_writes(items, e)
+        finally:
+            # Nothing taken off the queue may be left unresolved, even if the
+            # flusher is cancelled mid-batch.
+            _fail_writes(batch, RuntimeError("The database write was interrupted."))
+
+async def _flush_adds(items: List[tuple]):
+    """Inserts all queued rows in one statement; falls back to one insert per row on error."""
+    ids, symbols, names, prices = (list(column) for column in zip(*(params for _, params, _ in items)))
+    async with pool.acquire() as con:
+        try:
+            rows = await con.fetch(
+                "INSERT INTO cryptocurrencies (id, symbol, name, price_in_usd) "
+                "SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::numeric[]) RETURNING *",
+                ids, symbols, names, prices,
+            )
+        except Exception:
+            if len(items) == 1:
+                raise
+            # One bad row (e.g. a duplicate id) fails the whole statement, so
+            # retry individually to surface the error only to its own caller.
+            for _, params, fut in items:
+                try:
+                    row = await con.fetchrow(
+                        "INSERT INTO cryptocurrencies (id, symbol, name, price_in_usd) VALUES ($1, $2, $3, $4) RETURNING *",
+                        *params,
+                    )
+                    if not fut.done():
+                        fut.set_result(dict(row))
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+    inserted = {row['id']: dict(row) for row in rows}
+    for _, params, fut in items:
+        if not fut.done():
+            fut.set_result(inserted[params[0]])
+
+async def _flush_updates(items: List[tuple]):
+    """Applies all queued price updates in one statement; the last update per symbol wins."""
+    latest_prices = {symbol: price for _, (symbol, price), _ in items}
+    async with pool.acquire() as con:
+        rows = await con.fetch(
+            "UPDATE cryptocurrencies AS c SET price_in_usd = u.price "
+            "FROM unnest($1::text[], $2::numeric[]) AS u(symbol, price) "
+            "WHERE c.symbol = u.symbol RETURNING c.*",
+            list(latest_prices), list(latest_prices.values()),
+        )
+    updated = {row['symbol']: dict(row) for row in rows}
+    for _, (symbol, _), fut in items:
+        if not fut.done():
+            fut.set_result(updated.get(symbol))
+
+def _orjson_serializer(data: Any) -> str:
+    """Serializes tool results with orjson, writing timestamps as ISO-8601 UTC."""
+    return orjson.dumps(data, default=str, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z).decode()
 
 # --- MCP Server Setup ---
-mcp = FastMCP("Supabase Crypto DB MCP Server")
+mcp = FastMCP("Supabase Crypto DB MCP Server", lifespan=lifespan, tool_serializer=_orjson_serializer)
 
 # --- MCP Tools for Database Operations ---
 
 @mcp.tool
-def get_all_cryptocurrencies() -> List[Dict[str, Any]]:
+async def get_all_cryptocurrencies() -> List[Dict[str, Any]]:
     """
     Retrieves all cryptocurrency records from the Supabase database.
     Returns a list of dictionaries, where each dictionary represents a cryptocurrency.
     """
+    if _all_cache['data'] is not None and time.monotonic() - _all_cache['ts'] < _ALL_CACHE_TTL_SECONDS:
+        return _all_cache['data']
+    generation = _cache_generation
     try:
-        response = supabase.table('cryptocurrencies').select("*").execute()
-        # The actual data is in response.data
-        print(f"Successfully fetched {len(response.data)} records.")
-        return response.data
+        async with pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM cryptocurrencies")
+        print(f"Successfully fetched {len(rows)} records.")
+        records = [dict(r) for r in rows]
+        # A write during the read may make these rows stale; don't keep them then
+        if generation == _cache_generation:
+            _all_cache['data'] = records
+            _all_cache['ts'] = time.monotonic()
+        return records
     except Exception as e:
         print(f"Error fetching data from Supabase: {e}")
         return [{"error": str(e)}]
 
 @mcp.tool
-def get_cryptocurrency_by_symbol(symbol: str) -> Optional[Dict[str, Any]]:
+async def get_cryptocurrency_by_symbol(symbol: str) -> Optional[Dict[str, Any]]:
     """
     Retrieves a single cryptocurrency record by its symbol.
     :param symbol: The symbol of the cryptocurrency to fetch (e.g., 'BTC').
     """
+    if not _SYMBOL_RE.fullmatch(symbol):
+        return {"error": "invalid symbol"}
+    sym = symbol.upper()
+    cached = _sym_cache.get(sym)
+    if cached is not None:
+        return cached
+    generation = _cache_generation
     try:
-        # Using 'eq' for an exact match on the symbol
-        response = supabase.table('cryptocurrencies').select("*").eq('symbol', symbol.upper()).execute()
-        if response.data:
+        # Using '=' for an exact match on the symbol
+        async with pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM cryptocurrencies WHERE symbol = $1", sym)
+        if row:
             print(f"Successfully fetched record for symbol: {symbol}")
-            return response.data[0]
+            record = dict(row)
+            if generation == _cache_generation:
+                _sym_cache[sym] = record
+            return record
         else:
             print(f"No record found for symbol: {symbol}")
             return None
@@ -69,7 +317,7 @@ def get_cryptocurrency_by_symbol(symbol: str) -> Optional[Dict[str, Any]]:
         return {"error": str(e)}
 
 @mcp.tool
-def add_cryptocurrency(id: str, symbol: str, name: str, price_in_usd: float) -> Dict[str, Any]:
+async def add_cryptocurrency(id: str, symbol: str, name: str, price_in_usd: float) -> Dict[str, Any]:
     """
     Adds a new cryptocurrency to the database.
     The 'last_updated' field is handled automatically by the database (as CURRENT_TIMESTAMP).
@@ -78,36 +326,37 @@ def add_cryptocurrency(id: str, symbol: str, name: str, price_in_usd: float) ->
     :param name: The name of the new cryptocurrency (e.g., 'Bitcoin').
     :param price_in_usd: The current price in USD.
     """
+    if not _SYMBOL_RE.fullmatch(symbol):
+        return {"error": "invalid symbol"}
+    sym = symbol.upper()
     try:
-        # The insert method returns a response object with the inserted data
-        response = supabase.table('cryptocurrencies').insert({
-            "id": id,
-            "symbol": symbol.upper(),
-            "name": name,
-            "price_in_usd": price_in_usd
-        }).execute()
+        # Batched with any other concurrent writes; resolves to the inserted row
+        row = await _enqueue_write('add', (id, sym, name, price_in_usd))
+        _invalidate_caches(sym)
         print(f"Successfully added new cryptocurrency: {name}")
-        return response.data[0]
+        return row
     except Exception as e:
         print(f"Error adding cryptocurrency {name}: {e}")
         return {"error": str(e)}
 
 @mcp.tool
-def update_cryptocurrency_price(symbol: str, new_price: float) -> Optional[Dict[str, Any]]:
+async def update_cryptocurrency_price(symbol: str, new_price: float) -> Optional[Dict[str, Any]]:
     """
     Updates the price of an existing cryptocurrency identified by its symbol.
     :param symbol: The symbol of the cryptocurrency to update.
     :param new_price: The new price in USD.
     """
+    if not _SYMBOL_RE.fullmatch(symbol):
+        return {"error": "invalid symbol"}
+    sym = symbol.upper()
     try:
-        # The update method returns a response object with the updated data
-        response = supabase.table('cryptocurrencies').update({
-            "price_in_usd": new_price
-        }).eq('symbol', symbol.upper()).execute()
-        
-        if response.data:
+        # Batched with any other concurrent writes; resolves to the updated row
+        row = await _enqueue_write('update', (sym, new_price))
+        _invalidate_caches(sym)
+
+        if row:
             print(f"Successfully updated price for {symbol}.")
-            return response.data[0]
+            return row
         else:
             print(f"Could not update price. Symbol '{symbol}' not found.")
             return None
@@ -116,26 +365,25 @@ def update_cryptocurrency_price(symbol: str, new_price: float) -> Optional[Dict[
         return {"error": str(e)}
         
 @mcp.tool
-def delete_cryptocurrency(symbol: str) -> Dict[str, str]:
+async def delete_cryptocurrency(symbol: str) -> Dict[str, Any]:
     """
     Deletes a cryptocurrency from the database by its symbol.
     :param symbol: The symbol of the cryptocurrency to delete.
     """
+    if not _SYMBOL_RE.fullmatch(symbol):
+        return {"status": "Error", "details": "invalid symbol"}
+    sym = symbol.upper()
     try:
-        # First, find the record to be deleted to return its info
-        select_response = supabase.table('cryptocurrencies').select("*").eq('symbol', symbol.upper()).execute()
-        if not select_response.data:
-            return {"status": f"Error: Cryptocurrency with symbol '{symbol}' not found."}
+        # Delete the record and get its info back in a single round-trip
+        async with pool.acquire() as con:
+            delete_row = await con.fetchrow("DELETE FROM cryptocurrencies WHERE symbol = $1 RETURNING *", sym)
+        _invalidate_caches(sym)
 
-        # Now, delete the record
-        delete_response = supabase.table('cryptocurrencies').delete().eq('symbol', symbol.upper()).execute()
-        
-        if delete_response.data:
+        if delete_row:
             print(f"Successfully deleted cryptocurrency with symbol: {symbol}")
-            return {"status": f"Successfully deleted {symbol}", "deleted_record": delete_response.data[0]}
+            return {"status": f"Successfully deleted {symbol}", "deleted_record": dict(delete_row)}
         else:
-            # This case might happen if the record is deleted between the select and delete calls
-            return {"status": f"Error: Could not delete cryptocurrency with symbol '{symbol}'."}
+            return {"status": f"Error: Cryptocurrency with symbol '{symbol}' not found."}
 
     except Exception as e:
         print(f"Error deleting cryptocurrency {symbol}: {e}")
@@ -1,18 +1,26 @@
 import os
-import time
-import requests
-import json
+import asyncio
+import random
+import httpx
+import orjson
 from datetime import datetime, timezone
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Set
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError, field_validator
+from typing import FrozenSet, List, Optional
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, Client, PostgrestAPIError
 
 # Use Pydantic-AI for agent capabilities
 from pydantic_ai import Agent
 from pydantic_ai.models.openai import OpenAIModel
 from pydantic_ai.providers.openai import OpenAIProvider
 
+# Use uvloop for a faster asyncio event loop where it is available (not on Windows)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # --- 1. Load Environment Variables & Initialize Clients ---
 load_dotenv()
 
@@ -23,23 +31,54 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 # CoinGecko API Key
 COINGECKO_API_KEY = os.getenv("CRYPTO_API_KEY")
 
+# Route each cycle through the Llama 3.2 agent instead of calling the tool directly
+USE_AI_AGENT = os.getenv("USE_AI_AGENT", "false").lower() == "true"
+
+# Shared async HTTP client so TCP/TLS connections are reused across cycles
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=10,
+    headers={"Accept": "application/json"},
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=4),
+)
+
+# Validators from the last CoinGecko response, sent back so an unchanged
+# snapshot comes back as an empty 304 instead of the full payload
+_last_etag: Optional[str] = None
+_last_modified: Optional[str] = None
+
 # --- 2. Define the Rich Data Schema (from V3) ---
 class CryptoInfo(BaseModel):
     """Represents the rich data for a single cryptocurrency."""
+    # Immutable (and therefore hashable) once validated from the API
+    model_config = ConfigDict(frozen=True, populate_by_name=True)
+
     id: str = Field(..., description="The unique ID of the cryptocurrency, e.g., 'bitcoin'.")
-    symbol: str = Field(..., description="The ticker symbol, e.g., 'btc'.")
+    symbol: str = Field(..., description="The ticker symbol, e.g., 'BTC'.")
     name: str = Field(..., description="The display name, e.g., 'Bitcoin'.")
     price_in_usd: float = Field(..., alias="current_price", description="The current price in USD.")
     last_updated: datetime = Field(..., description="The timestamp of the last price update.")
 
+    @field_validator('symbol')
+    @classmethod
+    def _normalize_symbol(cls, v: str) -> str:
+        """Stores symbols upper-cased, matching how the MCP server queries them."""
+        return v.upper()
+
+# Validates a whole list of coins in a single pydantic-core call
+_COINS_ADAPTER = TypeAdapter(List[CryptoInfo])
+
+# The coins parsed from the last full response, reused on a 304
+_last_coins_data: List[CryptoInfo] = []
+
 # --- 3. Define Tools for the AI Agent ---
 
-def fetch_top_50_coins_data() -> List[CryptoInfo]:
+async def fetch_top_50_coins_data() -> List[CryptoInfo]:
     """
     Fetches rich data for the top 50 cryptocurrencies from CoinGecko.
-    This function acts as a 'tool' for our AI agent. It's reliable and fast.
+    The main loop calls it directly, and it doubles as a 'tool' for the optional AI agent.
     """
-    print("🤖 AI Agent triggered tool: fetch_top_50_coins_data")
+    print("Fetching top 50 coins from CoinGecko...")
     if not COINGECKO_API_KEY:
         raise ValueError("COINGECKO_API_KEY environment variable not found.")
 
@@ -53,12 +92,26 @@ def fetch_top_50_coins_data() -> List[CryptoInfo]:
         "x_cg_demo_api_key": COINGECKO_API_KEY
     }
     
-    response = requests.get(url, params=params)
+    global _last_etag, _last_modified, _last_coins_data
+    headers = {}
+    if _last_coins_data:
+        if _last_etag:
+            headers["If-None-Match"] = _last_etag
+        if _last_modified:
+            headers["If-Modified-Since"] = _last_modified
+
+    response = await _http.get(url, params=params, headers=headers)
+    if response.status_code == 304:
+        print(f"✅ Market data unchanged, reusing the last {len(_last_coins_data)} coins.")
+        return _last_coins_data
     response.raise_for_status()
     
     # Directly validate the API data into our Pydantic models.
     # This is far more reliable than asking an LLM to parse and format JSON.
-    coins_data = [CryptoInfo.model_validate(item) for item in response.json()]
+    coins_data = _COINS_ADAPTER.validate_python(orjson.loads(response.content))
+    _last_etag = response.headers.get("ETag")
+    _last_modified = response.headers.get("Last-Modified")
+    _last_coins_data = coins_data
     print(f"✅ Successfully fetched and validated data for {len(coins_data)} coins.")
     return coins_data
 
@@ -71,20 +124,37 @@ def upsert_crypto_data(supabase_client: Client, data: List[CryptoInfo]):
         return
 
     print(f"Uploading {len(data)} records to Supabase...")
-    data_to_upsert = [
-        coin.model_dump(by_alias=True, exclude={'last_updated'}) | {'last_updated': coin.last_updated.isoformat()}
-        for coin in data
-    ]
+    # mode='json' emits the timestamps as ISO-8601 strings in the same pass
+    data_to_upsert = _COINS_ADAPTER.dump_python(data, by_alias=True, mode='json')
     
-    # The 'id' column is used as the conflict target for the upsert operation.
-    response = supabase_client.from_("cryptocurrencies").upsert(data_to_upsert, on_conflict='id').execute()
+    # The 'upsert_cryptos' database function upserts the whole batch in one
+    # set-based INSERT ... ON CONFLICT (id) statement. It returns nothing, so no
+    # rows are serialized back over the wire.
+    supabase_client.rpc('upsert_cryptos', {'payload': data_to_upsert}).execute()
     print("✅ Successfully upserted data to Supabase.")
 
 
-# --- 4. The Main Application Loop with AI Agent ---
-def main():
+def build_agent() -> Agent:
     """
-    Main function to run the AI-driven data fetching and database update cycle.
+    Initializes the Pydantic-AI Agent (using local Ollama Llama 3.2 from V2).
+    """
+    ollama_provider = OpenAIProvider(base_url='http://localhost:11434/v1', api_key='ollama')
+    ollama_model = OpenAIModel(model_name='llama3.2', provider=ollama_provider)
+    # Give the agent the 'fetch_top_50_coins_data' function as a tool it can use
+    agent = Agent(
+        model=ollama_model,
+        output_type=List[CryptoInfo],
+        tools=[fetch_top_50_coins_data]
+    )
+    print("Pydantic-AI agent initialized with Llama 3.2.")
+    return agent
+
+
+# --- 4. The Main Application Loop ---
+async def main():
+    """
+    Main function to run the data fetching and database update cycle.
+    Set USE_AI_AGENT=true to route each fetch through the Llama 3.2 agent.
     """
     if not all([SUPABASE_URL, SUPABASE_KEY]):
         print("❌ Supabase URL or Key not found. Exiting.")
@@ -94,58 +164,81 @@ def main():
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
     print("Supabase client initialized.")
 
-    # Initialize the Pydantic-AI Agent (using local Ollama Llama 3.2 from V2)
-    ollama_provider = OpenAIProvider(base_url='http://localhost:11434/v1', api_key='ollama')
-    ollama_model = OpenAIModel(model_name='llama3.2', provider=ollama_provider)
-    # Give the agent the 'fetch_top_50_coins_data' function as a tool it can use
-    agent = Agent(
-    model=ollama_model, 
-    output_type=List[CryptoInfo], 
-    tools=[fetch_top_50_coins_data] # <--- Changed to 'tools'
-)
-    print("Pydantic-AI agent initialized with Llama 3.2.")
+    # The agent is only needed when explicitly enabled; the fetch itself is deterministic.
+    agent = build_agent() if USE_AI_AGENT else None
 
     # --- State for "Active Listening" ---
-    previous_top_50_ids: Set[str] = set()
+    previous_top_50_ids: FrozenSet[str] = frozenset()
+    previous_fingerprint: Optional[int] = None
     update_interval_seconds = 5  # 5 seconds
-
-    while True:
-        print(f"\n--- Starting new data cycle at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
-        try:
-            # Step 1: Instruct the AI Agent to perform the task.
-            # The agent will determine that it needs to call the `fetch_top_50_coins_data` tool.
-            prompt = "Get the latest market data for the top 50 cryptocurrencies by market cap."
-            print(f"Sending prompt to agent: '{prompt}'")
-            
-            # The .run() method will execute the tool and return its validated output directly.
-            latest_coin_data: List[CryptoInfo] = agent.run_sync(prompt)
-
-            # Step 2: "Active Listening" - Check for changes in the top 50 list.
-            current_top_50_ids = {coin.id for coin in latest_coin_data}
-            
-            if previous_top_50_ids and current_top_50_ids != previous_top_50_ids:
-                new_coins = current_top_50_ids - previous_top_50_ids
-                dropped_coins = previous_top_50_ids - current_top_50_ids
-                if new_coins:
-                    print(f"📢 Market Shift Detected! New coins in top 50: {', '.join(new_coins)}")
-                if dropped_coins:
-                    print(f"📢 Market Shift Detected! Coins that dropped out of top 50: {', '.join(dropped_coins)}")
+    max_backoff_seconds = 300  # Upper bound on the wait after repeated API errors
+    wait_seconds = update_interval_seconds
+
+    try:
+        while True:
+            print(f"\n--- Starting new data cycle at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
+            try:
+                # Step 1: Fetch the latest market data.
+                if agent is not None:
+                    # The agent will determine that it needs to call the `fetch_top_50_coins_data` tool.
+                    prompt = "Get the latest market data for the top 50 cryptocurrencies by market cap."
+                    print(f"Sending prompt to agent: '{prompt}'")
+
+                    # The .run() method will execute the tool and return its validated output.
+                    result = await agent.run(prompt)
+                    latest_coin_data: List[CryptoInfo] = result.output
+                else:
+                    # No LLM round-trip needed: call the tool directly.
+                    latest_coin_data = await fetch_top_50_coins_data()
+
+                # Step 2: "Active Listening" - Check for changes in the top 50 list.
+                # The set differences are only worked out when the membership changed.
+                current_top_50_ids = frozenset(coin.id for coin in latest_coin_data)
+
+                if previous_top_50_ids and current_top_50_ids != previous_top_50_ids:
+                    new_coins = current_top_50_ids - previous_top_50_ids
+                    dropped_coins = previous_top_50_ids - current_top_50_ids
+                    if new_coins:
+                        print(f"📢 Market Shift Detected! New coins in top 50: {', '.join(new_coins)}")
+                    if dropped_coins:
+                        print(f"📢 Market Shift Detected! Coins that dropped out of top 50: {', '.join(dropped_coins)}")
             
-            # Update the state for the next cycle
-            previous_top_50_ids = current_top_50_ids
-
-            # Step 3: Upsert this data into your Supabase database.
-            upsert_crypto_data(supabase, latest_coin_data)
-
-        except requests.RequestException as e:
-            print(f"❌ API Error: Failed to fetch data from CoinGecko. {e}")
-        except ValidationError as e:
-            print(f"❌ Data Validation Error: The API data did not match our schema. {e}")
-        except Exception as e:
-            print(f"❌ An unexpected error occurred: {e}")
-
-        print(f"--- Cycle finished. Waiting for {update_interval_seconds} seconds... ---")
-        time.sleep(update_interval_seconds)
+                # Update the state for the next cycle
+                previous_top_50_ids = current_top_50_ids
+
+                # Step 3: Upsert this data into your Supabase database, unless
+                # neither the coins nor their prices changed since the last write.
+                fingerprint = hash(tuple((coin.id, coin.price_in_usd) for coin in latest_coin_data))
+                if fingerprint == previous_fingerprint:
+                    print("No price changes since the last cycle. Skipping upload.")
+                else:
+                    try:
+                        # The Supabase client is synchronous, so run it off the event loop.
+                        await asyncio.to_thread(upsert_crypto_data, supabase, latest_coin_data)
+                        previous_fingerprint = fingerprint
+                    except (httpx.HTTPError, PostgrestAPIError) as e:
+                        # Supabase also speaks httpx; keep its errors out of the CoinGecko backoff
+                        print(f"❌ Database Error: Failed to upsert data to Supabase. {e}")
+
+                # A successful cycle resets any backoff from earlier API errors
+                wait_seconds = update_interval_seconds
+
+            except httpx.HTTPError as e:
+                print(f"❌ API Error: Failed to fetch data from CoinGecko. {e}")
+                # Back off exponentially so errors and rate limits (429) don't hammer the API
+                wait_seconds = min(wait_seconds * 2, max_backoff_seconds)
+            except ValidationError as e:
+                print(f"❌ Data Validation Error: The API data did not match our schema. {e}")
+            except Exception as e:
+                print(f"❌ An unexpected error occurred: {e}")
+
+            # Jitter keeps retries from lining up with other clients of the API
+            sleep_seconds = wait_seconds + random.uniform(0, 1) if wait_seconds > update_interval_seconds else wait_seconds
+            print(f"--- Cycle finished. Waiting for {sleep_seconds:.1f} seconds... ---")
+            await asyncio.sleep(sleep_seconds)
+    finally:
+        # The shared HTTP client outlives each cycle; release its connections on exit
+        await _http.aclose()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file